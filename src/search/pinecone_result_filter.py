@@ -1,12 +1,32 @@
 ﻿"""Pinecone 결과 필터"""
-from typing import Dict, List, Any
-from collections import OrderedDict
+from typing import Dict, List, Any, Tuple
+import asyncio
+import heapq
+from operator import itemgetter
 import logging
 import time
 
 logger = logging.getLogger(__name__)
 
 
+def _max_per_id(results: List[Tuple[str, float]]) -> Dict[str, float]:
+    """
+    (mb_sn, score) 리스트에서 mb_sn별 최고 점수 계산 (한 번 순회)
+
+    Args:
+        results: [(mb_sn, score), ...] (Pinecone 순위 순)
+
+    Returns:
+        {mb_sn: 최고 점수} (처음 등장한 순서 유지)
+    """
+    mb_sn_scores = {}
+    for mb_sn, score in results:
+        prev = mb_sn_scores.get(mb_sn)
+        if prev is None or score > prev:
+            mb_sn_scores[mb_sn] = score
+    return mb_sn_scores
+
+
 class PineconeResultFilter:
     """카테고리 순서에 따라 단계적으로 mb_sn을 필터링 (Pinecone 최적화)"""
 
@@ -35,6 +55,9 @@ class PineconeResultFilter:
         if not category_order:
             return []
 
+        # 필터 딕셔너리는 한 번만 정규화 (루프마다 빈 dict 생성 방지)
+        topic_filters = topic_filters or {}
+
         filter_start = time.time()
 
         # 첫 번째 카테고리로 초기 선별
@@ -45,7 +68,7 @@ class PineconeResultFilter:
             return []
 
         # 첫 번째 카테고리의 메타데이터 필터 가져오기
-        first_filter = (topic_filters or {}).get(first_category, {})
+        first_filter = topic_filters.get(first_category) or {}
         has_metadata_filter = bool(first_filter)
 
 
@@ -63,45 +86,56 @@ class PineconeResultFilter:
             else:
                 initial_count = max(final_count * 10, 2000)
 
-        first_results = self.searcher.search_by_category(
+        # 메타데이터 필터가 있으면 작은 top_k부터 시작해 잘린 경우에만 확장
+        if has_metadata_filter:
+            start_count = max((final_count or 200) * 20, 2000)
+        else:
+            start_count = initial_count
+
+        first_results = self._adaptive_search(
+            start_k=start_count,
+            max_k=initial_count,
             query_embedding=first_embedding,
             category=first_category,
-            top_k=initial_count,
             filter_mb_sns=None,  # 첫 단계는 전체 검색
             metadata_filter=first_filter
         )
 
+        # 카테고리가 하나뿐이면 첫 단계 점수로 바로 최종 선별 (후보 구성/루프 생략)
+        if len(category_order) == 1:
+            return self._select_final(_max_per_id(first_results), final_count)
+
         # 메타데이터 필터 사용 시 - 필터 조건 만족하는 패널 중 유사도 높은 순으로 정렬
         if has_metadata_filter:
             # 필터 조건을 만족하는 패널의 유사도 점수 수집
-            filtered_mb_sn_scores = {}
-            for r in first_results:
-                mb_sn = r.get("mb_sn", "")
-                if mb_sn:
-                    score = r.get("score", 0.0)
-                    # 최고 점수만 유지 (여러 카테고리에서 같은 mb_sn이 나올 수 있음)
-                    if mb_sn not in filtered_mb_sn_scores or score > filtered_mb_sn_scores[mb_sn]:
-                        filtered_mb_sn_scores[mb_sn] = score
+            # 최고 점수만 유지 (여러 카테고리에서 같은 mb_sn이 나올 수 있음)
+            filtered_mb_sn_scores = _max_per_id(first_results)
             
             #  유사도 점수 기준으로 정렬 (필터 조건 만족하는 패널 중에서)
             sorted_filtered = sorted(
                 filtered_mb_sn_scores.items(), 
-                key=lambda x: x[1], 
+                key=itemgetter(1), 
                 reverse=True  # 높은 점수부터
             )
             
             # 필터가 있을 때는 전체 유지 (조기 제한 없음)
             candidate_mb_sns = [mb_sn for mb_sn, score in sorted_filtered]
+
+            # 이후 카테고리가 모두 건너뛰어지면 첫 단계 점수가 최종 점수
+            last_scores = filtered_mb_sn_scores
             
         else:
             # 필터 없을 때
             # 정렬 순서 유지하며 후보군 구성
             first_sorted = sorted(
-                [r for r in first_results if r.get("mb_sn")],
-                key=lambda x: x["score"],
+                first_results,
+                key=itemgetter(1),
                 reverse=True
             )
-            candidate_mb_sns = list(OrderedDict.fromkeys(r["mb_sn"] for r in first_sorted))
+            candidate_mb_sns = list(dict.fromkeys(mb_sn for mb_sn, score in first_sorted))
+
+            # 첫 단계 점수는 이후 카테고리가 모두 건너뛰어진 경우에만 루프 뒤에서 계산
+            last_scores = None
 
             if final_count is not None and not has_metadata_filter:
                 candidate_mb_sns = candidate_mb_sns[:max(final_count * 10, 10000)]
@@ -118,7 +152,7 @@ class PineconeResultFilter:
                 continue
 
             # 현재 카테고리의 메타데이터 필터 가져오기
-            category_filter = (topic_filters or {}).get(category, {})
+            category_filter = topic_filters.get(category) or {}
             has_category_filter = bool(category_filter)
 
 
@@ -136,10 +170,17 @@ class PineconeResultFilter:
 
             search_count = max(search_count, 1)
 
-            results = self.searcher.search_by_category(
+            # 메타데이터 필터가 있으면 작은 top_k부터 시작해 잘린 경우에만 확장
+            if has_category_filter:
+                start_count = max((final_count or 200) * 20, 2000)
+            else:
+                start_count = search_count
+
+            results = self._adaptive_search(
+                start_k=start_count,
+                max_k=search_count,
                 query_embedding=embedding,
                 category=category,
-                top_k=search_count,
                 filter_mb_sns=candidate_mb_sns,  # 이전 단계에서 선별된 mb_sn들로 제한
                 metadata_filter=category_filter
             )
@@ -147,76 +188,134 @@ class PineconeResultFilter:
             # 메타데이터 필터 여부에 따라 다른 전략
             if has_category_filter:
                 # 메타데이터 필터 O → 필터 조건 만족하는 패널 중 유사도 높은 순으로 정렬
-                filtered_mb_sns = set([r["mb_sn"] for r in results if r.get("mb_sn") in candidate_mb_sns])
-                
                 # mb_sn별 최고 점수로 정렬 (여러 카테고리에서 같은 mb_sn이 나올 수 있음)
-                mb_sn_scores = {}
-                for r in results:
-                    mb_sn = r.get("mb_sn", "")
-                    if mb_sn in filtered_mb_sns:
-                        score = r.get("score", 0.0)
-                        if mb_sn not in mb_sn_scores or score > mb_sn_scores[mb_sn]:
-                            mb_sn_scores[mb_sn] = score
+                # Pinecone 필터($in)로 후보 mb_sn만 반환되므로 별도 후보 검사 불필요
+                mb_sn_scores = _max_per_id(results)
                 
                 # 유사도 점수 기준으로 정렬 (필터 조건 만족하는 패널 중에서)
-                sorted_mb_sns = sorted(mb_sn_scores.items(), key=lambda x: x[1], reverse=True)
+                sorted_mb_sns = sorted(mb_sn_scores.items(), key=itemgetter(1), reverse=True)
                 
                 # 필터가 있을 때는 전체 유지 (조기 제한 없음)
                 candidate_mb_sns = [mb_sn for mb_sn, score in sorted_mb_sns]
+                last_scores = mb_sn_scores
                 
             else:
                 # 메타데이터 필터 X → 벡터 유사도 기반 상위 선별
-                mb_sn_scores = {}
-                for r in results:
-                    mb_sn = r.get("mb_sn", "")
-                    if mb_sn in candidate_mb_sns:
-                        if mb_sn not in mb_sn_scores or r.get("score", 0.0) > mb_sn_scores[mb_sn]:
-                            mb_sn_scores[mb_sn] = r.get("score", 0.0)
-
-                sorted_mb_sns = sorted(mb_sn_scores.items(), key=lambda x: x[1], reverse=True)
-                
+                # Pinecone 필터($in)로 후보 mb_sn만 반환되므로 별도 후보 검사 불필요
+                mb_sn_scores = _max_per_id(results)
+
                 # 다음 단계를 위한 후보 수 결정
                 if final_count is None:
                     # 명수 미명시 → 전체 유지
-                    next_candidate_count = len(sorted_mb_sns)
+                    next_candidate_count = len(mb_sn_scores)
                 else:
-                    # 명수 명시 → 여유있게, 최소 10000개 보장
-                    next_candidate_count = max(final_count * 3, 10000)
-                
-                candidate_mb_sns = [mb_sn for mb_sn, score in sorted_mb_sns[:next_candidate_count]]
+                    # 명수 명시 → 여유있게, 최소 10000개 보장 (실제 결과 수를 넘지 않도록 제한)
+                    next_candidate_count = min(max(final_count * 3, 10000), len(mb_sn_scores))
+
+                # 상위 N개만 필요하므로 부분 정렬
+                sorted_mb_sns = heapq.nlargest(next_candidate_count, mb_sn_scores.items(), key=itemgetter(1))
+                candidate_mb_sns = [mb_sn for mb_sn, _ in sorted_mb_sns]
+                last_scores = mb_sn_scores
+
+        # 이후 카테고리 임베딩이 모두 없으면 첫 단계 점수가 최종 점수
+        if last_scores is None:
+            last_scores = _max_per_id(first_results)
 
         # 최종 결과도 score 정렬 보장 (마지막 카테고리 점수만 사용)
-        final_results = self.searcher.search_by_category(
-            query_embedding=embeddings[category_order[-1]],
-            category=category_order[-1],
-            top_k=len(candidate_mb_sns),
-            filter_mb_sns=candidate_mb_sns
+        # 마지막 단계에서 이미 계산한 점수를 재사용 (Pinecone 재검색 생략)
+        return self._select_final(last_scores, final_count)
+
+    async def filter_by_categories_async(
+        self,
+        embeddings: Dict[str, List[float]],
+        category_order: List[str],
+        final_count: int = None,
+        topic_filters: Dict[str, Dict[str, Any]] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        filter_by_categories의 비동기 버전 (이벤트 루프를 막지 않도록 워커 스레드에서 실행)
+
+        단계별 검색은 이전 단계 결과에 의존하므로 순차 실행은 그대로 유지
+
+        Args:
+            embeddings: {"카테고리명": [임베딩 벡터]}
+            category_order: 카테고리 순서 (예: ["기본정보", "직업소득", "자동차"])
+            final_count: 최종 출력할 mb_sn 개수 (None이면 조건 만족하는 전체 반환)
+            topic_filters: topic별 메타데이터 필터 (예: {"기본정보": {...}, "직업소득": {...}})
+
+        Returns:
+            최종 선별된 mb_sn 리스트
+        """
+        return await asyncio.to_thread(
+            self.filter_by_categories,
+            embeddings=embeddings,
+            category_order=category_order,
+            final_count=final_count,
+            topic_filters=topic_filters
         )
 
-        final_scores = {}
-        for r in final_results:
-            mb_sn = r.get("mb_sn", "")
-            if mb_sn in candidate_mb_sns:
-                score = r.get("score", 0.0)
-                # 최고 점수만 유지 (여러 카테고리에서 같은 mb_sn이 나올 수 있음)
-                if mb_sn not in final_scores or score > final_scores[mb_sn]:
-                    final_scores[mb_sn] = score
-
-        final_sorted = sorted(final_scores.items(), key=lambda x: x[1], reverse=True)
-        
-        final_mb_sns = [mb_sn for mb_sn, score in final_sorted]
-        
+    def _adaptive_search(self, start_k: int, max_k: int, **search_kwargs) -> List[Tuple[str, float]]:
+        """
+        top_k를 점진적으로 늘려가며 검색 (선택적인 필터일 때 불필요한 대량 검색 방지)
+
+        Pinecone 원본 매치 수가 요청한 top_k보다 적으면 잘리지 않은 것이므로 그대로 반환하고,
+        top_k만큼 꽉 찼으면 4배씩 늘려 max_k까지 재검색
+        메타데이터 필터 결과가 0개면 확장 없이 필터 없는 max_k 검색으로 한 번만 Fallback
+
+        Args:
+            start_k: 처음 요청할 top_k
+            max_k: top_k 상한
+            **search_kwargs: search_by_category에 전달할 나머지 인자
+
+        Returns:
+            [(mb_sn, score), ...]
+        """
+        top_k = min(start_k, max_k)
+        while True:
+            # Fallback 결과는 항상 꽉 찬 페이지라 확장 판단을 흐리므로 검색기 Fallback은 끔
+            # 빈 mb_sn 매치가 빠진 튜플 수로는 잘림을 판단할 수 없으므로 원본 매치 수를 함께 받음
+            results, match_count = self.searcher.search_by_category(
+                top_k=top_k, as_tuples=True, allow_fallback=False, with_match_count=True, **search_kwargs
+            )
+
+            # 🔄 Fallback: 필터 만족 결과가 0개면 메타데이터 필터 없이 max_k로 한 번만 재검색
+            if match_count == 0 and search_kwargs.get("metadata_filter"):
+                fallback_kwargs = dict(search_kwargs, metadata_filter=None)
+                return self.searcher.search_by_category(top_k=max_k, as_tuples=True, **fallback_kwargs)
+
+            if match_count < top_k or top_k >= max_k:
+                return results
+            top_k = min(top_k * 4, max_k)
+
+    def _select_final(
+        self,
+        final_scores: Dict[str, float],
+        final_count: int = None
+    ) -> List[Dict[str, Any]]:
+        """
+        mb_sn별 점수를 유사도 내림차순으로 정렬하여 최종 결과 구성
+
+        Args:
+            final_scores: {mb_sn: 점수}
+            final_count: 최종 출력할 mb_sn 개수 (None이면 전체 반환)
+
+        Returns:
+            [{"mb_sn": ..., "score": ...}]
+        """
         if final_count is not None:
-            final_mb_sns = final_mb_sns[:final_count]
+            # 상위 final_count개만 필요하므로 전체 정렬 대신 부분 정렬
+            final_sorted = heapq.nlargest(final_count, final_scores.items(), key=itemgetter(1))
             logger.info(
-                f"최종 {len(final_mb_sns)}개 패널 선별 완료 ({final_count}명 요청)"
+                "최종 %d개 패널 선별 완료 (%d명 요청)", len(final_sorted), final_count
             )
         else:
+            final_sorted = sorted(final_scores.items(), key=itemgetter(1), reverse=True)
             logger.info(
-                f"최종 {len(final_mb_sns)}개 패널 선별 완료 (조건 만족하는 전체 반환)"
+                "최종 %d개 패널 선별 완료 (조건 만족하는 전체 반환)", len(final_sorted)
             )
 
-        final_results = [{"mb_sn": mb_sn, "score": final_scores.get(mb_sn, 0.0)} for mb_sn in final_mb_sns]
+        # 정렬된 (mb_sn, score) 쌍에서 바로 결과 구성 (점수 재조회 없음)
+        final_results = [{"mb_sn": mb_sn, "score": score} for mb_sn, score in final_sorted]
 
         return final_results
 
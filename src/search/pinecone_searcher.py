@@ -1,6 +1,6 @@
 ﻿"""Pinecone 검색기"""
 import os
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Tuple, Union
 from pinecone import Pinecone
 import logging
 
@@ -71,8 +71,11 @@ class PineconePanelSearcher:
         category: str,
         top_k: int,
         filter_mb_sns: List[str] = None,
-        metadata_filter: Dict[str, Any] = None
-    ) -> List[Dict[str, Any]]:
+        metadata_filter: Dict[str, Any] = None,
+        as_tuples: bool = False,
+        allow_fallback: bool = True,
+        with_match_count: bool = False
+    ) -> Union[List[Dict[str, Any]], List[Tuple[str, float]], Tuple[list, int]]:
         """
         특정 카테고리로 Pinecone 검색 (메타데이터 필터 + Fallback 지원)
 
@@ -80,19 +83,26 @@ class PineconePanelSearcher:
             query_embedding: 쿼리 임베딩 벡터
             category: 검색할 카테고리 (예: "기본정보", "직업소득", "자동차")
             top_k: 검색 결과 개수
-            filter_mb_sns: 필터링할 mb_sn 리스트 (이 중에서만 검색)
+            filter_mb_sns: 필터링할 mb_sn 리스트 (Pinecone 필터로 이 중에서만 검색, 결과에 다른 mb_sn 없음)
             metadata_filter: Pinecone 메타데이터 필터 (topic별로 다름)
+            as_tuples: True면 (mb_sn, score) 튜플 리스트 반환 (빈 mb_sn 제외)
+            allow_fallback: False면 메타데이터 필터 결과가 없거나 오류여도 필터 없이 재검색하지 않음
+            with_match_count: True면 (결과, Pinecone 원본 매치 개수) 튜플 반환 (빈 mb_sn 제외 전 개수)
 
         Returns:
             [{"id": ..., "score": ..., "mb_sn": ..., "index": ..., "topic": ..., "text": ...}]
+            as_tuples=True인 경우 [(mb_sn, score), ...]
+            with_match_count=True인 경우 (위 결과, 원본 매치 개수)
         """
+        empty = ([], 0) if with_match_count else []
+
         # top_k 유효성 검사
         if top_k <= 0:
-            return []
+            return empty
 
         # 후보 mb_sn이 비어있는 경우 처리
         if filter_mb_sns is not None and len(filter_mb_sns) == 0:
-            return []
+            return empty
 
         # 카테고리에 해당하는 Pinecone topic 가져오기
         pinecone_topic = self.category_config.get(category, {}).get("pinecone_topic", category)
@@ -106,18 +116,24 @@ class PineconePanelSearcher:
 
         # 1차 시도: 메타데이터 필터 적용
         if metadata_filter:
-            filter_with_metadata = filter_dict.copy()
+            metadata_conditions = {}
             # 리스트 값을 $in 연산자로 변환
             for key, value in metadata_filter.items():
                 if isinstance(value, list):
                     # 리스트인 경우 $in 연산자 사용
-                    filter_with_metadata[key] = {"$in": value}
+                    metadata_conditions[key] = {"$in": value}
                 elif isinstance(value, dict):
                     # 이미 Pinecone 필터 형식인 경우 (예: {"$lte": 300})
-                    filter_with_metadata[key] = value
+                    metadata_conditions[key] = value
                 else:
                     # 단일 값인 경우 그대로 사용
-                    filter_with_metadata[key] = value
+                    metadata_conditions[key] = value
+
+            if "mb_sn" in filter_dict and "mb_sn" in metadata_conditions:
+                # 메타데이터 필터가 후보 mb_sn 제한을 덮어쓰지 않도록 $and로 결합
+                filter_with_metadata = {"$and": [filter_dict, metadata_conditions]}
+            else:
+                filter_with_metadata = {**filter_dict, **metadata_conditions}
 
             # Pinecone 검색 (메타데이터 필터 포함)
             # top_k를 그대로 사용 (제한 없음)
@@ -133,7 +149,7 @@ class PineconePanelSearcher:
                 valid_results = list(search_results.matches)
 
                 # 🔄 Fallback: 결과가 0개면 메타데이터 필터 없이 재검색
-                if len(valid_results) == 0:
+                if len(valid_results) == 0 and allow_fallback:
                     search_results = self.index.query(
                         vector=query_embedding,
                         top_k=top_k,
@@ -142,6 +158,9 @@ class PineconePanelSearcher:
                     )
                     valid_results = list(search_results.matches)
             except Exception as e:
+                if not allow_fallback:
+                    logger.warning(f"Pinecone 검색 오류 (메타데이터 필터): {e}")
+                    return empty
                 logger.warning(f"Pinecone 검색 오류 (메타데이터 필터): {e}, Fallback 시도")
                 # Fallback: 메타데이터 필터 없이 재검색
                 search_results = self.index.query(
@@ -166,12 +185,23 @@ class PineconePanelSearcher:
                 valid_results = list(search_results.matches)
             except Exception as e:
                 logger.error(f"Pinecone 검색 오류: {e}")
-                return []
+                return empty
 
         # Pinecone이 이미 정렬된 결과를 그대로 사용 (재정렬하지 않음)
+        valid_results = valid_results[:top_k]
+
+        # 점수 집계용: (mb_sn, score)만 추출하고 mb_sn 없는 결과는 미리 제외
+        if as_tuples:
+            pairs = []
+            for match in valid_results:
+                mb_sn = (match.metadata or {}).get("mb_sn")
+                if mb_sn:
+                    pairs.append((mb_sn, match.score))
+            return (pairs, len(valid_results)) if with_match_count else pairs
+
         # 결과 변환 (상위 top_k개만)
         matches = []
-        for match in valid_results[:top_k]:
+        for match in valid_results:
             metadata = match.metadata or {}
             matches.append({
                 "id": match.id,
@@ -185,5 +215,5 @@ class PineconePanelSearcher:
                 "성별": metadata.get("성별", "")
             })
 
-        return matches
+        return (matches, len(valid_results)) if with_match_count else matches
 